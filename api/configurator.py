@@ -2,6 +2,14 @@
     Configuration GUI
 '''
 
+from time import time
+# Recorded before the other imports so that the time to ready includes them
+IMPORT_TIME = time()
+
+import atexit
+import base64
+import binascii
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 import glob
 import hashlib
@@ -10,30 +18,35 @@ import os
 import re
 from shutil import copyfile
 import sys
-from time import time
+import threading
+from time import sleep
 import traceback
-from flask import Flask, g, render_template, request, jsonify
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify
 from flask_cors import CORS
 from flask_pymongo import PyMongo
 from flask_swagger import swagger
 import pymongo
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, \
+                                     SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+import bson
+from bson.timestamp import Timestamp
 from jwt import decode
 
 TEMPLATE = "An exception of type {0} occurred. Arguments:{1!r}"
 
 __version__ = '1.5.0'
-app = Flask(__name__)
-app.config.from_pyfile("config.cfg")
-CORS(app, supports_credentials=True)
-g = PyMongo(app)
-print(g.db)
+bp = Blueprint('configurator', __name__)
+mongo = PyMongo()
 CV_optional = ['access_list', 'definition', 'display_name', 'version', 'is_current']
-app.config['STARTTIME'] = time()
-app.config['STARTDT'] = datetime.now()
-app.config['LAST_TRANSACTION'] = time()
+REQUEST_LOCK = threading.Lock()
+READ_PREFERENCES = {'primary': Primary, 'primaryPreferred': PrimaryPreferred,
+                    'secondary': Secondary, 'secondaryPreferred': SecondaryPreferred,
+                    'nearest': Nearest}
 
 
-@app.before_request
+@bp.before_app_request
 def before_request():
     ''' Code to run before a request is processed
         Keyword arguments:
@@ -41,10 +54,11 @@ def before_request():
         Returns:
           None
     '''
-    app.config['REQUEST_TIME'] = time()
-    app.config['COUNTER'] += 1
-    endpoint = request.endpoint if request.endpoint else '(Unknown)'
-    app.config['ENDPOINTS'][endpoint] = app.config['ENDPOINTS'].get(endpoint, 0) + 1
+    current_app.config['REQUEST_TIME'] = time()
+    current_app.config['COUNTER'] += 1
+    endpoint = endpoint_name()
+    current_app.config['ENDPOINTS'][endpoint] = \
+        current_app.config['ENDPOINTS'].get(endpoint, 0) + 1
 
 
 # *****************************************************************************
@@ -79,6 +93,18 @@ class InvalidUsage(Exception):
 # *****************************************************************************
 
 
+def endpoint_name():
+    ''' Get the current request's endpoint without the blueprint prefix
+        Keyword arguments:
+          None
+        Returns:
+          Endpoint name
+    '''
+    if not request.endpoint:
+        return '(Unknown)'
+    return request.endpoint.rsplit('.', 1)[-1]
+
+
 def initialize_result():
     ''' Initialize the standard JSON return
         Keyword arguments:
@@ -88,7 +114,7 @@ def initialize_result():
     '''
     result = {"rest" : {'requester': request.remote_addr,
                         'url': request.url,
-                        'endpoint': request.endpoint,
+                        'endpoint': endpoint_name(),
                         'error': False,
                         'elapsed_time': '',
                         'user': 'unknown'}}
@@ -98,13 +124,13 @@ def initialize_result():
             dtok = decode(token, verify=False)
             if 'user_name' in dtok:
                 result['rest']['user'] = dtok['user_name']
-                app.config['USERS'][dtok['user_name']] = \
-                    app.config['USERS'].get(dtok['user_name'], 0) + 1
+                current_app.config['USERS'][dtok['user_name']] = \
+                    current_app.config['USERS'].get(dtok['user_name'], 0) + 1
         except Exception as err:
             message = TEMPLATE.format(type(err).__name__, err.args)
             # raise InvalidUsage(message, 500)
             print(message)
-    app.config['LAST_TRANSACTION'] = time()
+    current_app.config['LAST_TRANSACTION'] = time()
     return result
 
 
@@ -115,10 +141,166 @@ def generate_response(result):
         Returns:
           JSON
     '''
-    result['rest']['elapsed_time'] = str(timedelta(seconds=time() - app.config['REQUEST_TIME']))
+    result['rest']['elapsed_time'] = \
+        str(timedelta(seconds=time() - current_app.config['REQUEST_TIME']))
     return jsonify(**result)
 
 
+def get_read_preference(endpoint=None):
+    ''' Get the read preference for an endpoint
+        Keyword arguments:
+          endpoint: endpoint name (defaults to the current request's endpoint)
+        Returns:
+          pymongo read preference
+    '''
+    if not endpoint:
+        endpoint = endpoint_name()
+    mode = current_app.config['ROUTE_READ_PREFERENCE'].get(endpoint, 'primary')
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](
+        max_staleness=current_app.config['MONGO_MAX_STALENESS_SECONDS'])
+
+
+def operation_token(session):
+    ''' Build the read-your-writes token for a session. The token is the
+        operation time ("time.inc"), followed by the session's signed cluster
+        time as base64-encoded BSON, so that another client can gossip it.
+        Keyword arguments:
+          session: causally consistent session
+        Returns:
+          Token string or None (standalone servers have no operation time)
+    '''
+    optime = session.operation_time
+    if not optime:
+        return None
+    token = f"{optime.time}.{optime.inc}"
+    if session.cluster_time:
+        token += "." + base64.urlsafe_b64encode(bson.encode(session.cluster_time)).decode()
+    return token
+
+
+def get_operation_token():
+    ''' Get the operation time token passed back by a client (if any)
+        Keyword arguments:
+          None
+        Returns:
+          Token string or None
+    '''
+    return request.headers.get('X-Operation-Time', request.args.get('operation_time'))
+
+
+def get_operation_time():
+    ''' Parse the operation time token passed back by a client (if any)
+        Keyword arguments:
+          None
+        Returns:
+          Tuple of bson Timestamp and cluster time document (either may be None)
+    '''
+    token = get_operation_token()
+    if not token:
+        return None, None
+    try:
+        parts = token.split('.')
+        optime = Timestamp(int(parts[0]), int(parts[1]))
+        cluster_time = None
+        if len(parts) == 3:
+            cluster_time = bson.decode(base64.urlsafe_b64decode(parts[2]))
+        elif len(parts) != 2:
+            raise ValueError("expected time.inc[.cluster_time]")
+        return optime, cluster_time
+    except (IndexError, TypeError, ValueError, binascii.Error,
+            bson.errors.InvalidBSON) as err:
+        raise InvalidUsage(f"Invalid operation_time {token}: {err}") from err
+
+
+def read_session():
+    ''' Start a causally consistent session if the client passed an operation time
+        Keyword arguments:
+          None
+        Returns:
+          Session context (a no-op context if there is no operation time)
+    '''
+    optime, cluster_time = get_operation_time()
+    if not optime:
+        return nullcontext()
+    session = mongo.cx.start_session(causal_consistency=True)
+    # The cluster time must be advanced first, or a secondary that this client
+    # hasn't heard the write's cluster time from will reject afterClusterTime
+    if cluster_time:
+        session.advance_cluster_time(cluster_time)
+    session.advance_operation_time(optime)
+    return session
+
+
+def read_collection(session=None, primary=False):
+    ''' Get the configuration collection for reading
+        Keyword arguments:
+          session: causally consistent session (or None)
+          primary: read from the primary instead of the endpoint's read preference
+        Returns:
+          pymongo collection
+    '''
+    options = {'read_preference': Primary() if primary else get_read_preference()}
+    if session:
+        # Majority reads are needed for read-your-writes on secondaries
+        options['read_concern'] = ReadConcern('majority')
+    return mongo.db[current_app.config['MONGODB_COLLECTION']].with_options(**options)
+
+
+def find_configs(session, *args, primary=False, **kwargs):
+    ''' Find configurations in MongoDB. Causally consistent reads are limited to
+        MONGO_MAX_TIME_MS so that a lagging secondary can't block the request.
+        Keyword arguments:
+          session: causally consistent session (or None)
+          primary: read from the primary instead of the endpoint's read preference
+          args/kwargs: arguments to find()
+        Returns:
+          List of configuration documents
+    '''
+    if session:
+        kwargs['max_time_ms'] = current_app.config['MONGO_MAX_TIME_MS']
+    try:
+        return list(read_collection(session, primary).find(*args, session=session, **kwargs))
+    except pymongo.errors.ExecutionTimeout as err:
+        raise InvalidUsage("Timed out waiting for a replica to reach operation_time " \
+                           + f"{get_operation_token()}: {err}", 504) from err
+
+
+def update_config(result, configtype, ddict):
+    ''' Upsert a configuration in MongoDB. The operation time of the write is
+        returned so that clients can pass it back to read their own writes.
+        Keyword arguments:
+          result: return result
+          configtype: configuration type
+          ddict: configuration document
+        Returns:
+          None
+    '''
+    coll = mongo.db[current_app.config['MONGODB_COLLECTION']]
+    coll = coll.with_options(write_concern=WriteConcern(
+        w='majority', wtimeout=current_app.config['MONGO_WTIMEOUT_MS']))
+    # A timed out (or failed) write may still have been applied on the primary
+    current_app.config['CACHE'].pop(configtype, None)
+    try:
+        with mongo.cx.start_session(causal_consistency=True) as session:
+            data = coll.update_one({"type": configtype}, {"$set": ddict}, upsert=True,
+                                   session=session)
+            token = operation_token(session)
+        result['rest']['matched_count'] = data.matched_count
+        result['rest']['modified_count'] = data.modified_count
+        result['rest']['upserted_id'] = str(data.upserted_id)
+        result['rest']['updated' if data.matched_count else 'inserted'] = 1
+        if token:
+            result['rest']['operation_time'] = token
+    except pymongo.errors.WTimeoutError as err:
+        raise InvalidUsage("Timed out waiting for a majority to acknowledge configuration " \
+                           + f"{configtype} (it may not be replicated): {err}", 504) from err
+    except Exception as ex:
+        message = TEMPLATE.format(type(ex).__name__, ex.args)
+        raise InvalidUsage(f"Could not import configuration for {configtype}: {message}")
+
+
 def config_from_file(result, configtype):
     ''' Get a configuration from a file
         Keyword arguments:
@@ -129,7 +311,7 @@ def config_from_file(result, configtype):
     '''
     print(f"In config_from_file, reading {configtype}")
     result['rest']['method'] = 'file'
-    filepath = app.config['CONFIG_PATH'] + configtype + '.json'
+    filepath = current_app.config['CONFIG_PATH'] + configtype + '.json'
     if os.path.exists(filepath):
         try:
             with open(filepath, encoding="utf-8") as data_file:
@@ -140,25 +322,79 @@ def config_from_file(result, configtype):
         raise InvalidUsage(f"Configuration {configtype} was not found on filesystem", 404)
 
 
-def config_from_mongo(result, configtype, failover=True, ignore_not_found=False):
+def cache_config(doc):
+    ''' Save a configuration in the in-memory cache
+        Keyword arguments:
+          doc: configuration document
+        Returns:
+          None
+    '''
+    current_app.config['CACHE'][doc['type']] = {'doc': doc, 'loaded': time()}
+
+
+def is_cached(configtype):
+    ''' Determine if a configuration is kept in the in-memory cache. Only the
+        warm-up configurations are cached, and only if CONFIG_CACHE_TTL is set.
+        Keyword arguments:
+          configtype: configuration type
+        Returns:
+          True or False
+    '''
+    return bool(current_app.config['CONFIG_CACHE_TTL']) \
+        and configtype in current_app.config['WARMUP_TYPES']
+
+
+def cached_config(configtype):
+    ''' Get a configuration from the in-memory cache
+        Keyword arguments:
+          configtype: configuration type
+        Returns:
+          Configuration document or None if not cached (or expired)
+    '''
+    entry = current_app.config['CACHE'].get(configtype)
+    if not entry or time() - entry['loaded'] > current_app.config['CONFIG_CACHE_TTL']:
+        return None
+    return entry['doc']
+
+
+def config_from_mongo(result, configtype, failover=True, ignore_not_found=False,
+                      cached=False):
     ''' Get a configuration from MongoDB
         Keyword arguments:
           result: return result
           configtype: configuration type
           failover: allow failover to file
           ignore_not_found: do not issue error if config was not found
+          cached: allow the configuration to come from the in-memory cache
         Returns:
           None
     '''
     print(f"In config_from_mongo, reading {configtype}")
     result['rest']['method'] = 'mongodb'
-    try:
-        data = g.db[app.config['MONGODB_COLLECTION']].find({"type": configtype})
-    except pymongo.errors.PyMongoError:
-        if failover:
-            config_from_file(result, configtype)
-        else:
-            raise InvalidUsage(f"Configuration {configtype} was not found", 404)
+    # Cached configurations are refreshed from the primary so that a stale
+    # secondary can't be cached for another CONFIG_CACHE_TTL seconds
+    cached = cached and is_cached(configtype) and not get_operation_token()
+    if cached:
+        doc = cached_config(configtype)
+        if doc:
+            result['rest']['method'] = 'cache'
+            result['config'] = doc['data']
+            for opt in CV_optional:
+                if opt in doc:
+                    result[opt] = doc[opt]
+            return
+    with read_session() as session:
+        try:
+            data = find_configs(session, {"type": configtype}, primary=cached)
+            if data and cached:
+                cache_config(data[0])
+        except pymongo.errors.PyMongoError as err:
+            if failover:
+                config_from_file(result, configtype)
+                return
+            message = TEMPLATE.format(type(err).__name__, err.args)
+            raise InvalidUsage(f"Could not read configuration {configtype} " \
+                               + f"from MongoDB: {message}", 500) from err
     if ignore_not_found:
         return
     try:
@@ -184,10 +420,11 @@ def dump_to_file(configtype, result, backup=False):
         Returns:
           None
     '''
-    filepath = app.config['CONFIG_PATH'] + configtype + '.json'
+    filepath = current_app.config['CONFIG_PATH'] + configtype + '.json'
     if backup and os.path.exists(filepath):
         timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%dT%H%M%S')
-        backuppath = app.config['CONFIG_PATH'] + 'backup/' + configtype + '.json.' + timestamp
+        backuppath = current_app.config['CONFIG_PATH'] + 'backup/' + configtype \
+                     + '.json.' + timestamp
         try:
             copyfile(filepath, backuppath)
         except Exception as ex:
@@ -230,37 +467,197 @@ def validate_configtype(doc):
     return vresult
 
 
+def count_request(configtype):
+    ''' Count a request for a configuration. Counts are also kept for the next
+        flush to MongoDB, so that warm-up can rank configurations across workers.
+        Keyword arguments:
+          configtype: configuration type
+        Returns:
+          None
+    '''
+    current_app.config['REQUESTS'][configtype] = \
+        current_app.config['REQUESTS'].get(configtype, 0) + 1
+    with REQUEST_LOCK:
+        pending = current_app.config['PENDING_REQUESTS']
+        pending[configtype] = pending.get(configtype, 0) + 1
+
+
+def flush_request_counts(app):
+    ''' Add the request counts since the last flush to MongoDB
+        Keyword arguments:
+          app: Flask app
+        Returns:
+          None
+    '''
+    with REQUEST_LOCK:
+        pending = app.config['PENDING_REQUESTS']
+        app.config['PENDING_REQUESTS'] = {}
+    if not pending:
+        return
+    updates = [pymongo.UpdateOne({"type": configtype}, {"$inc": {"count": count}},
+                                 upsert=True)
+               for configtype, count in pending.items()]
+    try:
+        mongo.db[app.config['REQUEST_COUNTS_COLLECTION']].bulk_write(updates, ordered=False)
+    except Exception as ex:
+        message = TEMPLATE.format(type(ex).__name__, ex.args)
+        print(f"Could not save request counts: {message}")
+        with REQUEST_LOCK:
+            for configtype, count in pending.items():
+                app.config['PENDING_REQUESTS'][configtype] = \
+                    app.config['PENDING_REQUESTS'].get(configtype, 0) + count
+
+
+def flush_request_counts_periodically(app):
+    ''' Flush request counts every REQUEST_COUNTS_FLUSH_SECONDS (run in a thread)
+        Keyword arguments:
+          app: Flask app
+        Returns:
+          None
+    '''
+    while True:
+        sleep(app.config['REQUEST_COUNTS_FLUSH_SECONDS'])
+        flush_request_counts(app)
+
+
+def top_requested(app):
+    ''' Get the most requested configurations from the saved request counts
+        Keyword arguments:
+          app: Flask app
+        Returns:
+          List of configuration types
+    '''
+    try:
+        coll = mongo.db[app.config['REQUEST_COUNTS_COLLECTION']]
+        cursor = coll.find({}, {"_id": 0, "type": 1}).sort("count", -1) \
+                     .limit(app.config['WARMUP_TOP_N'])
+        return [doc['type'] for doc in cursor]
+    except Exception as ex:
+        message = TEMPLATE.format(type(ex).__name__, ex.args)
+        print(f"Could not read request counts: {message}")
+        return []
+
+
+def get_swagger_spec():
+    ''' Get the swagger spec (built once per app)
+        Keyword arguments:
+          None
+        Returns:
+          Swagger spec
+    '''
+    if 'SWAGGER_SPEC' not in current_app.config:
+        swag = swagger(current_app)
+        swag['info']['version'] = "1.0"
+        swag['info']['title'] = "Configurator"
+        current_app.config['SWAGGER_SPEC'] = swag
+    return current_app.config['SWAGGER_SPEC']
+
+
+def warm_up(app):
+    ''' Preload configurations into the cache and build the swagger spec
+        before the app accepts traffic
+        Keyword arguments:
+          app: Flask app
+        Returns:
+          None
+    '''
+    with app.app_context():
+        get_swagger_spec()
+        configtypes = list(app.config['WARMUP_CONFIGS'])
+        if not app.config['CONFIG_CACHE_TTL']:
+            if configtypes or app.config['WARMUP_TOP_N']:
+                print("CONFIG_CACHE_TTL is 0, so configurations will not be preloaded")
+            return
+        if app.config['WARMUP_TOP_N']:
+            for configtype in top_requested(app):
+                if configtype not in configtypes:
+                    configtypes.append(configtype)
+        if not configtypes:
+            return
+        app.config['WARMUP_TYPES'] = configtypes
+        try:
+            for doc in read_collection(primary=True).find({"type": {"$in": configtypes}}):
+                cache_config(doc)
+        except Exception as ex:
+            message = TEMPLATE.format(type(ex).__name__, ex.args)
+            print(f"Could not warm up configurations: {message}")
+        print(f"Warmed up {len(app.config['CACHE'])}/{len(configtypes)} configurations")
+
+
+def create_app():
+    ''' Create the app. The Mongo connection is made lazily on first use.
+        Keyword arguments:
+          None
+        Returns:
+          Flask app
+    '''
+    app = Flask(__name__)
+    app.config.from_pyfile("config.cfg")
+    app.config.setdefault('MONGO_MAX_STALENESS_SECONDS', -1)
+    app.config.setdefault('ROUTE_READ_PREFERENCE', {})
+    app.config.setdefault('MONGO_WTIMEOUT_MS', 5000)
+    app.config.setdefault('MONGO_MAX_TIME_MS', 5000)
+    for endpoint, mode in app.config['ROUTE_READ_PREFERENCE'].items():
+        if mode not in READ_PREFERENCES:
+            raise ValueError(f"Invalid read preference {mode} for {endpoint} " \
+                             + f"(must be one of {', '.join(READ_PREFERENCES)})")
+    staleness = app.config['MONGO_MAX_STALENESS_SECONDS']
+    if staleness != -1 and (not isinstance(staleness, int) or staleness < 90):
+        raise ValueError(f"Invalid MONGO_MAX_STALENESS_SECONDS {staleness} " \
+                         + "(must be -1 or at least 90)")
+    app.config.setdefault('CONFIG_CACHE_TTL', 0)
+    app.config.setdefault('WARMUP_CONFIGS', [])
+    app.config.setdefault('WARMUP_TOP_N', 0)
+    app.config.setdefault('REQUEST_COUNTS_COLLECTION', 'request_counts')
+    app.config.setdefault('REQUEST_COUNTS_FLUSH_SECONDS', 60)
+    app.config.setdefault('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+    app.config['CACHE'] = {}
+    app.config['WARMUP_TYPES'] = []
+    app.config['PENDING_REQUESTS'] = {}
+    app.config['STARTTIME'] = time()
+    app.config['STARTDT'] = datetime.now()
+    app.config['LAST_TRANSACTION'] = time()
+    CORS(app, supports_credentials=True)
+    mongo.init_app(app, connect=False,
+                   serverSelectionTimeoutMS=app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'])
+    app.register_blueprint(bp)
+    warm_up(app)
+    threading.Thread(target=flush_request_counts_periodically, args=(app,),
+                     daemon=True).start()
+    atexit.register(flush_request_counts, app)
+    app.config['READY_TIME'] = time() - IMPORT_TIME
+    print(f"Configurator {__version__} ready in {app.config['READY_TIME']:.3f} sec")
+    return app
+
+
 # *****************************************************************************
 # * Endpoints                                                                 *
 # *****************************************************************************
 
 
-@app.errorhandler(InvalidUsage)
+@bp.app_errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
     return response
 
 
-@app.route('/')
+@bp.route('/')
 def show_swagger():
     return render_template('swagger_ui.html')
 
 
-@app.route("/spec")
+@bp.route("/spec")
 def spec():
     return get_doc_json()
 
 
-@app.route('/doc')
+@bp.route('/doc')
 def get_doc_json():
-    swag = swagger(app)
-    swag['info']['version'] = "1.0"
-    swag['info']['title'] = "Configurator"
-    return jsonify(swag)
+    return jsonify(get_swagger_spec())
 
 
-@app.route("/stats")
+@bp.route("/stats")
 def stats():
     '''
     Show stats
@@ -274,24 +671,28 @@ def stats():
       400:
           description: Stats could not be calculated
     '''
-    tbt = time() - app.config['LAST_TRANSACTION']
+    tbt = time() - current_app.config['LAST_TRANSACTION']
     result = initialize_result()
     try:
-        start = datetime.fromtimestamp(app.config['STARTTIME']).strftime('%Y-%m-%d %H:%M:%S')
-        up_time = datetime.now() - app.config['STARTDT']
+        start = datetime.fromtimestamp(current_app.config['STARTTIME']) \
+                        .strftime('%Y-%m-%d %H:%M:%S')
+        up_time = datetime.now() - current_app.config['STARTDT']
         result['stats'] = {"version": __version__,
-                           "requests": app.config['COUNTER'],
+                           "requests": current_app.config['COUNTER'],
                            "python": sys.version,
                            "pid": os.getpid(),
                            "start_time": start,
                            "uptime": str(up_time),
                            "time_since_last_transaction": tbt,
-                           "config_path": app.config['CONFIG_PATH'],
-                           "endpoint_counts": app.config['ENDPOINTS'],
-                           "user_counts": app.config['USERS'],
-                           "request_counts": app.config['REQUESTS'],
-                           "import_counts": app.config['IMPORTS'],
-                           "export_counts": app.config['EXPORTS']}
+                           "config_path": current_app.config['CONFIG_PATH'],
+                           "time_to_ready": current_app.config['READY_TIME'],
+                           "cached_configurations": sorted(current_app.config['CACHE']),
+                           "read_preferences": current_app.config['ROUTE_READ_PREFERENCE'],
+                           "endpoint_counts": current_app.config['ENDPOINTS'],
+                           "user_counts": current_app.config['USERS'],
+                           "request_counts": current_app.config['REQUESTS'],
+                           "import_counts": current_app.config['IMPORTS'],
+                           "export_counts": current_app.config['EXPORTS']}
         return generate_response(result)
     except Exception as ex:
         message = TEMPLATE.format(type(ex).__name__, ex.args)
@@ -300,7 +701,7 @@ def stats():
         raise InvalidUsage(f"Error: {message}")
 
 
-@app.route('/validate', methods=['GET'])
+@bp.route('/validate', methods=['GET'])
 def get_validations():
     '''
     Validate configurations
@@ -308,6 +709,12 @@ def get_validations():
     ---
     tags:
       - Configuration
+    parameters:
+      - in: query
+        name: operation_time
+        type: string
+        required: false
+        description: operation time returned by a write (read your own writes)
     responses:
       200:
           description: Validation results (1=match, 0=mismatch)
@@ -317,11 +724,14 @@ def get_validations():
     result = initialize_result()
     result['validations'] = {}
     result['rest']['method'] = 'mongodb'
-    try:
-        data = g.db[app.config['MONGODB_COLLECTION']].find({})
-    except Exception as ex:
-        message = TEMPLATE.format(type(ex).__name__, ex.args)
-        raise InvalidUsage(f"Error: {message}")
+    with read_session() as session:
+        try:
+            data = find_configs(session, {})
+        except InvalidUsage:
+            raise
+        except Exception as ex:
+            message = TEMPLATE.format(type(ex).__name__, ex.args)
+            raise InvalidUsage(f"Error: {message}")
     for doc in data:
         valresult = validate_configtype(doc)
         print(valresult)
@@ -329,7 +739,7 @@ def get_validations():
     return generate_response(result)
 
 
-@app.route('/configurations', methods=['GET'])
+@bp.route('/configurations', methods=['GET'])
 def get_configurations():
     '''
     Show available configurations
@@ -337,6 +747,12 @@ def get_configurations():
     ---
     tags:
       - Configuration
+    parameters:
+      - in: query
+        name: operation_time
+        type: string
+        required: false
+        description: operation time returned by a write (read your own writes)
     responses:
       200:
           description: List of configurations
@@ -346,18 +762,21 @@ def get_configurations():
     result = initialize_result()
     result['configlist'] = []
     result['rest']['method'] = 'mongodb'
-    try:
-        data = g.db[app.config['MONGODB_COLLECTION']].find({}, {"_id": 0, "type": 1}).sort("type")
-        for doc in data:
-            result['configlist'].append(doc['type'])
-    except Exception as ex:
-        message = TEMPLATE.format(type(ex).__name__, ex.args)
-        result['rest']['failover'] = message
-        result['rest']['method'] = 'file'
-        for filename in sorted(glob.glob(app.config['CONFIG_PATH'] + '*.json')):
-            filename = filename.replace(app.config['CONFIG_PATH'], '')
-            filename = filename.replace('.json', '')
-            result['configlist'].append(filename)
+    with read_session() as session:
+        try:
+            data = find_configs(session, {}, {"_id": 0, "type": 1}, sort=[("type", 1)])
+            for doc in data:
+                result['configlist'].append(doc['type'])
+        except InvalidUsage:
+            raise
+        except Exception as ex:
+            message = TEMPLATE.format(type(ex).__name__, ex.args)
+            result['rest']['failover'] = message
+            result['rest']['method'] = 'file'
+            for filename in sorted(glob.glob(current_app.config['CONFIG_PATH'] + '*.json')):
+                filename = filename.replace(current_app.config['CONFIG_PATH'], '')
+                filename = filename.replace('.json', '')
+                result['configlist'].append(filename)
     return generate_response(result)
 
 
@@ -377,7 +796,7 @@ def authenticate_access(result):
     return False
 
 
-@app.route('/config/<string:configtype>', methods=['GET'])
+@bp.route('/config/<string:configtype>', methods=['GET'])
 def get_config(configtype):
     '''
     Get configuration
@@ -391,6 +810,11 @@ def get_config(configtype):
         type: string
         required: true
         description: configuration type
+      - in: query
+        name: operation_time
+        type: string
+        required: false
+        description: operation time returned by a write (read your own writes)
     responses:
       200:
           description: Configuration JSON
@@ -399,15 +823,15 @@ def get_config(configtype):
     '''
     result = initialize_result()
     result['rest']['configtype'] = configtype
-    app.config['REQUESTS'][configtype] = app.config['REQUESTS'].get(configtype, 0) + 1
-    config_from_mongo(result, configtype)
+    count_request(configtype)
+    config_from_mongo(result, configtype, cached=True)
     if not authenticate_access(result):
         raise InvalidUsage(f"You are not authorized to access configuration {configtype}", 401)
     result['rest']['config_length'] = len(result['config'])
     return generate_response(result)
 
 
-@app.route('/config/<string:configtype>/<path:entry>', methods=['GET'])
+@bp.route('/config/<string:configtype>/<path:entry>', methods=['GET'])
 def get_config_entry(configtype, entry):
     '''
     Get a single entry from a configuration
@@ -433,6 +857,11 @@ def get_config_entry(configtype, entry):
         type: path
         required: true
         description: entry to return from configuration type
+      - in: query
+        name: operation_time
+        type: string
+        required: false
+        description: operation time returned by a write (read your own writes)
     responses:
       200:
           description: Configuration JSON
@@ -441,8 +870,8 @@ def get_config_entry(configtype, entry):
     '''
     result = initialize_result()
     result['rest']['configtype'] = configtype
-    app.config['REQUESTS'][configtype] = app.config['REQUESTS'].get(configtype, 0) + 1
-    config_from_mongo(result, configtype)
+    count_request(configtype)
+    config_from_mongo(result, configtype, cached=True)
     if entry in result['config']:
         result['config'] = result['config'][entry]
     else:
@@ -453,7 +882,7 @@ def get_config_entry(configtype, entry):
     return generate_response(result)
 
 
-@app.route('/export/<string:configtype>', methods=['OPTIONS', 'POST'])
+@bp.route('/export/<string:configtype>', methods=['OPTIONS', 'POST'])
 def export_config(configtype):
     '''
     Export configuration
@@ -477,7 +906,7 @@ def export_config(configtype):
     result['rest']['configtype'] = configtype
     if request.method == 'OPTIONS':
         return generate_response(result)
-    app.config['EXPORTS'][configtype] = app.config['EXPORTS'].get(configtype, 0) + 1
+    current_app.config['EXPORTS'][configtype] = current_app.config['EXPORTS'].get(configtype, 0) + 1
     config_from_mongo(result, configtype, False)
     if not authenticate_access(result):
         raise InvalidUsage(f"You are not authorized to access configuration {configtype}", 401)
@@ -485,7 +914,7 @@ def export_config(configtype):
     return generate_response(result)
 
 
-@app.route('/import/<string:configtype>', methods=['OPTIONS', 'POST'])
+@bp.route('/import/<string:configtype>', methods=['OPTIONS', 'POST'])
 def import_config(configtype):
     '''
     Import configuration from file
@@ -509,7 +938,7 @@ def import_config(configtype):
     result['rest']['configtype'] = configtype
     if request.method == 'OPTIONS':
         return generate_response(result)
-    app.config['IMPORTS'][configtype] = app.config['IMPORTS'].get(configtype, 0) + 1
+    current_app.config['IMPORTS'][configtype] = current_app.config['IMPORTS'].get(configtype, 0) + 1
     parms = {}
     if request.form:
         result['rest']['form'] = request.form
@@ -517,28 +946,18 @@ def import_config(configtype):
             parms[i] = request.form[i]
     config_from_file(result, configtype)
     ddict = {"type": configtype, "data": result['config']}
-    mongo = {"rest": {}}
-    config_from_mongo(mongo, configtype, False, True)
+    mresult = {"rest": {}}
+    config_from_mongo(mresult, configtype, False, True)
     for opt in CV_optional:
         if opt in parms:
             ddict[opt] = parms[opt]
-        elif opt in mongo:
-            ddict[opt] = mongo[opt]
-    try:
-        print(g.db)
-        data = g.db[app.config['MONGODB_COLLECTION']].update_one({"type": configtype},
-                                          {"$set": ddict}, upsert=True)
-        result['rest']['matched_count'] = data.matched_count
-        result['rest']['modified_count'] = data.modified_count
-        result['rest']['upserted_id'] = str(data.upserted_id)
-        result['rest']['updated' if data.matched_count else 'inserted'] = 1
-    except Exception as ex:
-        message = TEMPLATE.format(type(ex).__name__, ex.args)
-        raise InvalidUsage(f"Could not import configuration for {configtype}: {message}")
+        elif opt in mresult:
+            ddict[opt] = mresult[opt]
+    update_config(result, configtype, ddict)
     return generate_response(result)
 
 
-@app.route('/importjson/<string:configtype>', methods=['OPTIONS', 'POST'])
+@bp.route('/importjson/<string:configtype>', methods=['OPTIONS', 'POST'])
 def import_json_config(configtype):
     '''
     Import JSON configuration
@@ -586,7 +1005,7 @@ def import_json_config(configtype):
     result['rest']['configtype'] = configtype
     if request.method == 'OPTIONS':
         return generate_response(result)
-    app.config['IMPORTS'][configtype] = app.config['IMPORTS'].get(configtype, 0) + 1
+    current_app.config['IMPORTS'][configtype] = current_app.config['IMPORTS'].get(configtype, 0) + 1
     parms = {}
     if request.form:
         result['rest']['form'] = request.form
@@ -602,21 +1021,12 @@ def import_json_config(configtype):
     for this_parm in CV_optional:
         if this_parm in parms:
             ddict[this_parm] = parms[this_parm]
-    try:
-        data = g.db[app.config['MONGODB_COLLECTION']].update_one({"type": configtype},
-                                          {"$set": ddict}, upsert=True)
-        result['rest']['matched_count'] = data.matched_count
-        result['rest']['modified_count'] = data.modified_count
-        result['rest']['upserted_id'] = str(data.upserted_id)
-        result['rest']['updated' if data.matched_count else 'inserted'] = 1
-    except Exception as ex:
-        message = TEMPLATE.format(type(ex).__name__, ex.args)
-        raise InvalidUsage(f"Could not import configuration for {configtype}: {message}")
+    update_config(result, configtype, ddict)
     dump_to_file(configtype, result, True)
     return generate_response(result)
 
 
-@app.route('/importjson/<string:configtype>/<path:entry>', methods=['OPTIONS', 'POST'])
+@bp.route('/importjson/<string:configtype>/<path:entry>', methods=['OPTIONS', 'POST'])
 def import_json_config_entry(configtype, entry):
     '''
     Import JSON configuration/entry
@@ -653,7 +1063,7 @@ def import_json_config_entry(configtype, entry):
     result['rest']['entry'] = entry
     if request.method == 'OPTIONS':
         return generate_response(result)
-    app.config['IMPORTS'][configtype] = app.config['IMPORTS'].get(configtype, 0) + 1
+    current_app.config['IMPORTS'][configtype] = current_app.config['IMPORTS'].get(configtype, 0) + 1
     parms = {}
     if request.form:
         result['rest']['form'] = request.form
@@ -670,16 +1080,7 @@ def import_json_config_entry(configtype, entry):
     result['config'][entry] = result['rest']['config']
     new_config = result['config']
     ddict = {"type": configtype, "data": new_config}
-    try:
-        data = g.db[app.config['MONGODB_COLLECTION']].update_one({"type": configtype},
-                                          {"$set": ddict}, upsert=True)
-        result['rest']['matched_count'] = data.matched_count
-        result['rest']['modified_count'] = data.modified_count
-        result['rest']['upserted_id'] = str(data.upserted_id)
-        result['rest']['updated' if data.matched_count else 'inserted'] = 1
-    except Exception as ex:
-        message = TEMPLATE.format(type(ex).__name__, ex.args)
-        raise InvalidUsage(f"Could not import configuration for {configtype}: {message}")
+    update_config(result, configtype, ddict)
     # Export
     eresult = initialize_result()
     config_from_mongo(eresult, configtype, False)
@@ -689,4 +1090,4 @@ def import_json_config_entry(configtype, entry):
     return generate_response(result)
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()